@@ -1,80 +1,164 @@
 #!/usr/bin/env python3
 import argparse
 import base64
+import functools
+import hashlib
 import html
 import json
-import subprocess
+import os
+import threading
 import time
-from typing import Any, Dict, List, Optional
-from urllib.error import HTTPError
-from urllib.request import Request, urlopen
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+# orjson is optional; fall back to the stdlib encoder with the same compact output.
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    json_loads = json.loads
 
 TOKEN_URL = "https://oauth2.googleapis.com/token"
 SCOPE = "https://www.googleapis.com/auth/androidpublisher"
 API_BASE = "https://androidpublisher.googleapis.com/androidpublisher/v3"
 UPLOAD_BASE = "https://androidpublisher.googleapis.com/upload/androidpublisher/v3"
+# Percent-encoded once; the JWT assertion itself is base64url and needs no escaping.
+TOKEN_GRANT = "grant_type=" + urllib.parse.quote("urn:ietf:params:oauth:grant-type:jwt-bearer", safe="")
+
+# Release fields carried over when rewriting a track.
+RELEASE_FIELDS = (
+    "name",
+    "versionCodes",
+    "status",
+    "userFraction",
+    "countryTargeting",
+    "releaseNotes",
+    "inAppUpdatePriority",
+)
+
+# Statuses worth retrying in http_json: rate limiting and transient server errors.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_ATTEMPTS = 5
+
+# (connect, read) timeouts in seconds. Play can take minutes to process an
+# upload or to validate an edit on commit, so those get the long read timeout.
+HTTP_TIMEOUT = (10, 60)
+UPLOAD_TIMEOUT = (10, 600)
+
+# One keep-alive session per thread so every call after the first skips the
+# TCP + TLS handshake. requests doesn't document Session as thread-safe, so
+# worker threads (see main) get their own rather than sharing the main one.
+_THREAD_LOCAL = threading.local()
 
 
 def b64url(data: bytes) -> str:
     return base64.urlsafe_b64encode(data).decode("utf-8").rstrip("=")
 
 
+# The JWT header never changes, so encode it once.
+_JWT_HEADER_B64 = b64url(b'{"alg":"RS256","typ":"JWT"}')
+
+
+def session() -> requests.Session:
+    s = getattr(_THREAD_LOCAL, "session", None)
+    if s is None:
+        s = _THREAD_LOCAL.session = requests.Session()
+    return s
+
+
 def load_json(path: str) -> Dict[str, Any]:
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
+@functools.lru_cache(maxsize=8)
 def read_text(path: str) -> str:
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
 
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 16):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def truncate_unicode(s: str, max_chars: int) -> str:
-    arr = list(s)
-    if len(arr) <= max_chars:
+    # str indexing is already by code point, so no need to materialise a list.
+    if len(s) <= max_chars:
         return s
     if max_chars <= 1:
         return "…"
-    return "".join(arr[: max_chars - 1]) + "…"
+    return s[: max_chars - 1] + "…"
 
 
-def http_json(method: str, url: str, token: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+def http_json(
+        method: str,
+        url: str,
+        token: str,
+        body: Optional[Dict[str, Any]] = None,
+        retry: bool = True,
+        timeout: Tuple[int, int] = HTTP_TIMEOUT,
+) -> Dict[str, Any]:
     headers = {"Authorization": f"Bearer {token}"}
     data = None
     if body is not None:
-        data = json.dumps(body, separators=(",", ":")).encode("utf-8")
+        data = json_dumps(body)
         headers["Content-Type"] = "application/json"
 
-    req = Request(url, data=data, method=method, headers=headers)
-    try:
-        with urlopen(req) as resp:
-            raw = resp.read().decode("utf-8")
-            return json.loads(raw) if raw else {}
-    except HTTPError as e:
-        err = e.read().decode("utf-8", errors="replace")
-        raise RuntimeError(f"HTTP {e.code} {method} {url}\n{err}") from e
+    # Back off and retry rate-limited / transient failures, honouring Retry-After,
+    # rather than failing the job and redoing the whole publish.
+    attempts = MAX_ATTEMPTS if retry else 1
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        try:
+            resp = session().request(method, url, data=data, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+            time.sleep(2 ** attempt)
+            continue
+        if resp.status_code not in RETRY_STATUSES or last:
+            break
+        retry_after = resp.headers.get("Retry-After", "")
+        time.sleep(min(int(retry_after), 60) if retry_after.isdigit() else 2 ** attempt)
+
+    if not resp.ok:
+        raise RuntimeError(f"HTTP {resp.status_code} {method} {url}\n{resp.text}")
+    return json_loads(resp.content) if resp.content else {}
 
 
 def http_upload_octet(method: str, url: str, token: str, file_path: str) -> Dict[str, Any]:
+    # Pass the open file so the body is streamed rather than read into memory;
+    # requests derives Content-Length from the file size.
     with open(file_path, "rb") as f:
-        payload = f.read()
-
-    req = Request(
-        url,
-        data=payload,
-        method=method,
-        headers={
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/octet-stream",
-        },
-    )
-    try:
-        with urlopen(req) as resp:
-            raw = resp.read().decode("utf-8")
-            return json.loads(raw) if raw else {}
-    except HTTPError as e:
-        err = e.read().decode("utf-8", errors="replace")
-        raise RuntimeError(f"HTTP {e.code} UPLOAD {url}\n{err}") from e
+        resp = session().request(
+            method,
+            url,
+            data=f,
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/octet-stream",
+            },
+            timeout=UPLOAD_TIMEOUT,
+        )
+    if not resp.ok:
+        raise RuntimeError(f"HTTP {resp.status_code} UPLOAD {url}\n{resp.text}")
+    return json_loads(resp.content) if resp.content else {}
 
 
 def mint_access_token(service_account_json_path: str) -> str:
@@ -85,7 +169,6 @@ def mint_access_token(service_account_json_path: str) -> str:
     now = int(time.time())
     exp = now + 3600
 
-    header = {"alg": "RS256", "typ": "JWT"}
     claim = {
         "iss": client_email,
         "scope": SCOPE,
@@ -94,50 +177,27 @@ def mint_access_token(service_account_json_path: str) -> str:
         "exp": exp,
     }
 
-    key_path = "sa_key.pem"
-    with open(key_path, "w", encoding="utf-8") as f:
-        f.write(private_key)
-
-    signing_input = (
-        f"{b64url(json.dumps(header, separators=(',', ':')).encode())}"
-        f".{b64url(json.dumps(claim, separators=(',', ':')).encode())}"
-    )
-    sig = subprocess.check_output(
-        ["openssl", "dgst", "-sha256", "-sign", key_path],
-        input=signing_input.encode("utf-8"),
-    )
+    signing_input = f"{_JWT_HEADER_B64}.{b64url(json_dumps(claim))}"
+    # Sign in-process instead of shelling out to openssl so the key never touches disk.
+    pk = serialization.load_pem_private_key(private_key.encode("utf-8"), password=None)
+    sig = pk.sign(signing_input.encode("utf-8"), padding.PKCS1v15(), hashes.SHA256())
     jwt = f"{signing_input}.{b64url(sig)}"
 
-    form = f"grant_type=urn:ietf:params:oauth:grant-type:jwt-bearer&assertion={jwt}".encode("utf-8")
-    req = Request(
+    form = f"{TOKEN_GRANT}&assertion={jwt}".encode("utf-8")
+    resp = session().post(
         TOKEN_URL,
         data=form,
-        method="POST",
         headers={"Content-Type": "application/x-www-form-urlencoded"},
+        timeout=HTTP_TIMEOUT,
     )
-    try:
-        with urlopen(req) as resp:
-            data = json.loads(resp.read().decode("utf-8"))
-            return data["access_token"]
-    except HTTPError as e:
-        err = e.read().decode("utf-8", errors="replace")
-        raise RuntimeError(f"Failed to mint access token: HTTP {e.code}\n{err}") from e
+    if not resp.ok:
+        raise RuntimeError(f"Failed to mint access token: HTTP {resp.status_code}\n{resp.text}")
+    data = json_loads(resp.content)
+    return data["access_token"]
 
 
 def keep_fields(r: Dict[str, Any]) -> Dict[str, Any]:
-    out: Dict[str, Any] = {}
-    for k in (
-            "name",
-            "versionCodes",
-            "status",
-            "userFraction",
-            "countryTargeting",
-            "releaseNotes",
-            "inAppUpdatePriority",
-    ):
-        if k in r and r[k] is not None:
-            out[k] = r[k]
-    return out
+    return {k: v for k in RELEASE_FIELDS if (v := r.get(k)) is not None}
 
 
 def create_edit(token: str, package: str) -> str:
@@ -157,24 +217,37 @@ def update_track(token: str, package: str, edit_id: str, track: str, releases: L
     http_json("PUT", f"{API_BASE}/applications/{package}/edits/{edit_id}/tracks/{track}", token, body=body)
 
 
+def list_bundles(token: str, package: str, edit_id: str) -> List[Dict[str, Any]]:
+    resp = http_json("GET", f"{API_BASE}/applications/{package}/edits/{edit_id}/bundles", token)
+    return resp.get("bundles", []) or []
+
+
 def commit_edit(token: str, package: str, edit_id: str) -> None:
-    http_json("POST", f"{API_BASE}/applications/{package}/edits/{edit_id}:commit", token, body=None)
+    # Not retried: a 5xx or dropped connection can arrive after Play has already
+    # committed, and the repeat would then fail with a 4xx that hides the publish.
+    # For the same reason give Play the long read timeout to validate the edit.
+    http_json(
+        "POST",
+        f"{API_BASE}/applications/{package}/edits/{edit_id}:commit",
+        token,
+        body=None,
+        retry=False,
+        timeout=UPLOAD_TIMEOUT,
+    )
 
 
 def infer_locale_from_whatsnew(notes_file: str) -> str:
-    base = notes_file.split("/")[-1]
-    if base.startswith("whatsnew-"):
-        return base[len("whatsnew-"):]
-    return "en-US"
+    base = os.path.basename(notes_file)
+    return base.removeprefix("whatsnew-") if base.startswith("whatsnew-") else "en-US"
 
 
-def upload_bundle_and_symbols(token, edit_id_b, pkg, aab, native_symbols) -> str:
+def upload_bundle_and_symbols(token, edit_id, pkg, aab, native_symbols) -> str:
     # Upload AAB (bundle)
     already_uploaded = False
     try:
         bundle = http_upload_octet(
             "POST",
-            f"{UPLOAD_BASE}/applications/{pkg}/edits/{edit_id_b}/bundles?uploadType=media",
+            f"{UPLOAD_BASE}/applications/{pkg}/edits/{edit_id}/bundles?uploadType=media",
             token,
             aab,
         )
@@ -184,17 +257,27 @@ def upload_bundle_and_symbols(token, edit_id_b, pkg, aab, native_symbols) -> str
             raise
         # Bundle was uploaded in a previous committed edit; look up its version code.
         already_uploaded = True
-        resp = http_json("GET", f"{API_BASE}/applications/{pkg}/edits/{edit_id_b}/bundles", token)
-        codes = [b["versionCode"] for b in resp.get("bundles", [])]
-        if not codes:
+        bundles = list_bundles(token, pkg, edit_id)
+        if not bundles:
             raise
-        version_code = str(max(codes))
+        # When Play reports hashes, only accept the bundle that is this exact AAB:
+        # a mismatch means a different build already took this versionCode, and
+        # rolling it out would ship the wrong binary under this release name.
+        hashed = [b for b in bundles if b.get("sha256")]
+        if hashed:
+            digest = sha256_file(aab)
+            existing = next((b for b in hashed if b["sha256"].lower() == digest), None)
+            if existing is None:
+                raise
+            version_code = str(existing["versionCode"])
+        else:
+            version_code = str(max(b["versionCode"] for b in bundles))
 
     # Upload native debug symbols (nativeCode)
     try:
         http_upload_octet(
             "POST",
-            f"{UPLOAD_BASE}/applications/{pkg}/edits/{edit_id_b}/apks/{version_code}/deobfuscationFiles/nativeCode?uploadType=media",
+            f"{UPLOAD_BASE}/applications/{pkg}/edits/{edit_id}/apks/{version_code}/deobfuscationFiles/nativeCode?uploadType=media",
             token,
             native_symbols,
         )
@@ -206,6 +289,77 @@ def upload_bundle_and_symbols(token, edit_id_b, pkg, aab, native_symbols) -> str
     return version_code
 
 
+def settle_inprogress(releases: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], str]:
+    # Transition any inProgress rollout into a valid fallback state.
+    # A country-targeted staged rollout must sit on top of a completed release
+    # so users outside the target country still have an upgrade path.
+    # Returns the completed releases to carry into the new track and the
+    # action taken on the previous rollout.
+    previous_rollout_action = "none"
+    has_completed_fallback = any(r.get("status") == "completed" for r in releases)
+
+    # If there is no completed release yet, promote the current staged
+    # rollout to completed so the next country rollout has a fallback.
+    completing_inprogress = not has_completed_fallback
+    if not completing_inprogress:
+        for r in releases:
+            if r.get("status") != "inProgress":
+                continue
+            fraction = r.get("userFraction")
+            if fraction is None or fraction >= 1.0:
+                completing_inprogress = True
+                break
+
+    completed_only: List[Dict[str, Any]] = []
+    for r in releases:
+        status = r.get("status")
+        rr = keep_fields(r)
+
+        # keep drafts out; they often block releases anyway
+        if status == "draft":
+            continue
+
+        # Drop old completed releases when promoting inProgress to completed,
+        # because the Play API only allows one completed release per track.
+        if status == "completed" and completing_inprogress:
+            continue
+
+        if status == "inProgress":
+            fraction = rr.get("userFraction")
+            if completing_inprogress or fraction is None or fraction >= 1.0:
+                rr["status"] = "completed"
+                rr.pop("userFraction", None)
+                previous_rollout_action = "completed_for_fallback" if not has_completed_fallback else "completed"
+            else:
+                rr["status"] = "halted"
+                previous_rollout_action = "halted"
+
+        # Keep only completed releases to avoid "Too many staged releases specified."
+        # Strip countryTargeting so completed releases serve ALL countries as a
+        # fallback — otherwise country-targeted staged rollouts fail with
+        # "does not allow any existing users to upgrade".
+        if rr.get("status") == "completed":
+            rr.pop("countryTargeting", None)
+            completed_only.append(rr)
+
+    return completed_only, previous_rollout_action
+
+
+def rollout_releases(releases: List[Dict[str, Any]], new_release: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], str]:
+    # The track payload for the single edit: the completed fallback(s) left after
+    # settling the previous rollout, followed by the new staged release.
+    completed_only, previous_rollout_action = settle_inprogress(releases)
+
+    if not completed_only:
+        raise RuntimeError(
+            "Cannot start a country-targeted rollout without an existing completed fallback release. "
+            "Complete the current production rollout first, or publish a completed baseline release "
+            "before starting another country-only rollout."
+        )
+
+    return completed_only + [new_release], previous_rollout_action
+
+
 def main() -> int:
     ap = argparse.ArgumentParser()
     ap.add_argument("--service-account-json", required=True)
@@ -230,99 +384,19 @@ def main() -> int:
     pkg = args.package_name
     track_name = args.track
 
-    # -----------------------------
-    # Phase 1: Transition any inProgress rollout into a valid fallback state.
-    # A country-targeted staged rollout must sit on top of a completed release
-    # so users outside the target country still have an upgrade path.
-    # -----------------------------
-    previous_rollout_action = "none"
+    # Single edit: upload the new bundle, settle any inProgress rollout and
+    # start the new staged rollout, all in one commit.
+    #   Ensure only ONE staged release in payload by:
+    #     - keeping COMPLETED releases only
+    #     - dropping halted/draft staged releases
+    edit_id = create_edit(token, pkg)
 
-    edit_id_a = create_edit(token, pkg)
-    track_a = get_track(token, pkg, edit_id_a, track_name)
-    releases_a = track_a.get("releases", []) or []
-
-    # If there is an inProgress, move it to its next stable state in its own
-    # commit before creating the new rollout.
-    new_releases_a: List[Dict[str, Any]] = []
-    has_inprogress = any(r.get("status") == "inProgress" for r in releases_a)
-    has_completed_fallback = any(r.get("status") == "completed" for r in releases_a)
-
-    if has_inprogress:
-        # If there is no completed release yet, promote the current staged
-        # rollout to completed so the next country rollout has a fallback.
-        completing_inprogress = not has_completed_fallback
-        if not completing_inprogress:
-            for r in releases_a:
-                if r.get("status") != "inProgress":
-                    continue
-                fraction = r.get("userFraction")
-                if fraction is None or fraction >= 1.0:
-                    completing_inprogress = True
-                    break
-
-        for r in releases_a:
-            status = r.get("status")
-            rr = keep_fields(r)
-
-            # keep drafts out; they often block releases anyway
-            if status == "draft":
-                continue
-
-            # Drop old completed releases when promoting inProgress to completed,
-            # because the Play API only allows one completed release per track.
-            if status == "completed" and completing_inprogress:
-                continue
-
-            if status == "inProgress":
-                fraction = rr.get("userFraction")
-                if completing_inprogress or fraction is None or fraction >= 1.0:
-                    rr["status"] = "completed"
-                    rr.pop("userFraction", None)
-                    previous_rollout_action = "completed_for_fallback" if not has_completed_fallback else "completed"
-                else:
-                    rr["status"] = "halted"
-                    previous_rollout_action = "halted"
-
-            # Only inProgress releases may carry countryTargeting; strip from
-            # all releases since every inProgress is now halted or completed.
-            rr.pop("countryTargeting", None)
-            new_releases_a.append(rr)
-
-        update_track(token, pkg, edit_id_a, track_name, new_releases_a)
-        commit_edit(token, pkg, edit_id_a)
-    else:
-        # No commit needed; discard edit by not committing.
-        pass
-
-    # -----------------------------
-    # Phase 2: Upload new bundle + create new staged rollout
-    #         Ensure only ONE staged release in payload by:
-    #           - keeping COMPLETED releases only
-    #           - dropping halted/draft staged releases
-    # -----------------------------
-    edit_id_b = create_edit(token, pkg)
-    version_code = upload_bundle_and_symbols(token, edit_id_b, pkg, args.aab, args.native_symbols)
-
-    track_b = get_track(token, pkg, edit_id_b, track_name)
-    releases_b = track_b.get("releases", []) or []
-
-    # Keep only completed releases to avoid "Too many staged releases specified."
-    # Strip countryTargeting so completed releases serve ALL countries as a
-    # fallback — otherwise country-targeted staged rollouts fail with
-    # "does not allow any existing users to upgrade".
-    completed_only: List[Dict[str, Any]] = []
-    for r in releases_b:
-        if r.get("status") == "completed":
-            rr = keep_fields(r)
-            rr.pop("countryTargeting", None)
-            completed_only.append(rr)
-
-    if not completed_only:
-        raise RuntimeError(
-            "Cannot start a country-targeted rollout without an existing completed fallback release. "
-            "Complete the current production rollout first, or publish a completed baseline release "
-            "before starting another country-only rollout."
-        )
+    # Reading the track doesn't depend on the upload, so fetch it while the
+    # bundle and symbols are in flight.
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        track_future = pool.submit(get_track, token, pkg, edit_id, track_name)
+        version_code = upload_bundle_and_symbols(token, edit_id, pkg, args.aab, args.native_symbols)
+        track = track_future.result()
 
     locale = infer_locale_from_whatsnew(args.notes_file)
     notes_text = read_text(args.notes_file).strip()
@@ -337,10 +411,10 @@ def main() -> int:
         "inAppUpdatePriority": 0,
     }
 
-    releases_out = completed_only + [new_release]
+    releases_out, previous_rollout_action = rollout_releases(track.get("releases", []) or [], new_release)
 
-    update_track(token, pkg, edit_id_b, track_name, releases_out)
-    commit_edit(token, pkg, edit_id_b)
+    update_track(token, pkg, edit_id, track_name, releases_out)
+    commit_edit(token, pkg, edit_id)
 
     # Write outputs
     with open("play_outputs.json", "w", encoding="utf-8") as f:
@@ -362,10 +436,11 @@ def main() -> int:
     if play_link:
         play_link = play_link + ("&tab=releases" if "?" in play_link else "?tab=releases")
 
+    release_name = html.escape(args.release_name)
     msg = (
         f"<b>✅ Production rollout started</b>\n\n"
         f"<b>App:</b> {html.escape(args.app_name)}\n"
-        f"<b>Version:</b> {html.escape(args.release_name)}\n"
+        f"<b>Version:</b> {release_name}\n"
         f"<b>VersionCode:</b> <code>{html.escape(version_code)}</code>\n"
         f"<b>Package:</b> <code>{html.escape(pkg)}</code>\n\n"
         f"<b>Rollout:</b> {html.escape(args.user_fraction)}\n"
@@ -386,7 +461,7 @@ def main() -> int:
     if play_link:
         msg += f"<b>Play Console:</b> <a href=\"{html.escape(play_link)}\">Open production releases</a>\n"
     if args.github_release_url:
-        msg += f"<b>GitHub Release:</b> <a href=\"{html.escape(args.github_release_url)}\">{html.escape(args.release_name)}</a>\n"
+        msg += f"<b>GitHub Release:</b> <a href=\"{html.escape(args.github_release_url)}\">{release_name}</a>\n"
     msg += f"\n<b>Release notes:</b>\n<pre>{html.escape(raw_notes)}</pre>\n"
 
     with open(args.telegram_out, "w", encoding="utf-8") as f:
@@ -0,0 +1,190 @@
+import unittest
+from typing import Any, Dict, List, Optional, Tuple
+from unittest import mock
+
+import requests
+
+import publish_playstore
+from publish_playstore import commit_edit, http_json, rollout_releases, settle_inprogress, upload_bundle_and_symbols
+
+
+COUNTRY = {"countries": ["BD"], "includeRestOfWorld": False}
+NOTES = [{"language": "en-US", "text": "Fixes"}]
+
+
+def release(name: str, status: str, **extra: Any) -> Dict[str, Any]:
+    return {"name": name, "versionCodes": [name], "status": status, "releaseNotes": NOTES, **extra}
+
+
+class SettleInProgressTest(unittest.TestCase):
+    def test_no_inprogress_keeps_completed_only(self) -> None:
+        completed, action = settle_inprogress(
+            [
+                release("10", "completed", countryTargeting=COUNTRY, userFraction=None),
+                release("9", "halted", userFraction=0.2),
+            ]
+        )
+
+        self.assertEqual(action, "none")
+        self.assertEqual(completed, [release("10", "completed")])
+
+    def test_partial_inprogress_with_fallback_is_halted(self) -> None:
+        completed, action = settle_inprogress(
+            [
+                release("11", "inProgress", userFraction=0.5, countryTargeting=COUNTRY),
+                release("10", "completed"),
+            ]
+        )
+
+        self.assertEqual(action, "halted")
+        self.assertEqual(completed, [release("10", "completed")])
+
+    def test_full_fraction_inprogress_is_completed(self) -> None:
+        completed, action = settle_inprogress(
+            [
+                release("11", "inProgress", userFraction=1.0, countryTargeting=COUNTRY),
+                release("10", "completed"),
+            ]
+        )
+
+        self.assertEqual(action, "completed")
+        self.assertEqual(completed, [release("11", "completed")])
+
+    def test_inprogress_without_fallback_is_completed_for_fallback(self) -> None:
+        completed, action = settle_inprogress(
+            [release("11", "inProgress", userFraction=0.3, countryTargeting=COUNTRY)]
+        )
+
+        self.assertEqual(action, "completed_for_fallback")
+        self.assertEqual(completed, [release("11", "completed")])
+
+    def test_drafts_are_dropped(self) -> None:
+        for releases in (
+            [release("12", "draft"), release("10", "completed")],
+            [release("12", "draft"), release("11", "inProgress", userFraction=0.5), release("10", "completed")],
+        ):
+            with self.subTest(statuses=[r["status"] for r in releases]):
+                completed, _ = settle_inprogress(releases)
+
+                self.assertEqual(completed, [release("10", "completed")])
+
+
+class RolloutReleasesTest(unittest.TestCase):
+    NEW = release("12", "inProgress", userFraction=0.99, countryTargeting=COUNTRY)
+
+    def test_halted_rollout_is_omitted_from_single_edit(self) -> None:
+        releases_out, action = rollout_releases(
+            [
+                release("11", "inProgress", userFraction=0.5, countryTargeting=COUNTRY),
+                release("10", "completed"),
+            ],
+            self.NEW,
+        )
+
+        self.assertEqual(action, "halted")
+        self.assertEqual(releases_out, [release("10", "completed"), self.NEW])
+
+    def test_requires_a_completed_fallback(self) -> None:
+        with self.assertRaisesRegex(RuntimeError, "completed fallback"):
+            rollout_releases([release("11", "halted", userFraction=0.5)], self.NEW)
+
+
+class DuplicateVersionRecoveryTest(unittest.TestCase):
+    DUPLICATE = RuntimeError("HTTP 403 UPLOAD url\nAPK specifies a version code that has already been used.")
+
+    def recover(self, bundles: List[Dict[str, Any]]) -> Tuple[Any, mock.Mock]:
+        with (
+            mock.patch.object(publish_playstore, "http_upload_octet", side_effect=[self.DUPLICATE, {}]) as upload,
+            mock.patch.object(publish_playstore, "list_bundles", return_value=bundles),
+            mock.patch.object(publish_playstore, "sha256_file", return_value="ab12"),
+        ):
+            try:
+                result = upload_bundle_and_symbols("tok", "e1", "com.example", "app.aab", "symbols.zip")
+            except RuntimeError as e:
+                result = e
+        return result, upload
+
+    def test_uses_the_bundle_matching_the_aab_hash(self) -> None:
+        version_code, upload = self.recover(
+            [{"versionCode": 41, "sha256": "AB12"}, {"versionCode": 42, "sha256": "ffff"}]
+        )
+
+        self.assertEqual(version_code, "41")
+        self.assertIn("/apks/41/deobfuscationFiles/", upload.call_args.args[1])
+
+    def test_reraises_when_no_listed_hash_matches(self) -> None:
+        result, upload = self.recover([{"versionCode": 42, "sha256": "ffff"}])
+
+        self.assertIs(result, self.DUPLICATE)
+        self.assertEqual(upload.call_count, 1)
+
+    def test_falls_back_to_highest_version_without_hashes(self) -> None:
+        version_code, _ = self.recover([{"versionCode": 41}, {"versionCode": 42}])
+
+        self.assertEqual(version_code, "42")
+
+
+def response(status: int, body: bytes = b"{}", headers: Optional[Dict[str, str]] = None) -> mock.Mock:
+    return mock.Mock(status_code=status, ok=status < 400, content=body, text=body.decode(), headers=headers or {})
+
+
+class HttpJsonRetryTest(unittest.TestCase):
+    def run_with(self, outcomes: List[Any], call) -> Tuple[Any, mock.Mock, mock.Mock]:
+        fake = mock.Mock()
+        fake.request.side_effect = outcomes
+        with (
+            mock.patch.object(publish_playstore, "session", return_value=fake),
+            mock.patch.object(publish_playstore.time, "sleep") as sleep,
+        ):
+            try:
+                result = call()
+            except Exception as e:
+                result = e
+        return result, fake.request, sleep
+
+    def test_retries_transient_statuses_honouring_retry_after(self) -> None:
+        result, request, sleep = self.run_with(
+            [response(503, headers={"Retry-After": "7"}), response(429), response(200, b'{"id":"e1"}')],
+            lambda: http_json("GET", "https://example.test/track", "tok"),
+        )
+
+        self.assertEqual(result, {"id": "e1"})
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [7, 2])
+        self.assertEqual(request.call_args.kwargs["timeout"], publish_playstore.HTTP_TIMEOUT)
+
+    def test_retries_connection_errors_and_timeouts(self) -> None:
+        result, request, _ = self.run_with(
+            [requests.ConnectionError(), requests.ReadTimeout(), response(200)],
+            lambda: http_json("PUT", "https://example.test/track", "tok", body={}),
+        )
+
+        self.assertEqual(result, {})
+        self.assertEqual(request.call_count, 3)
+
+    def test_gives_up_after_max_attempts(self) -> None:
+        result, request, _ = self.run_with(
+            [response(500)] * publish_playstore.MAX_ATTEMPTS,
+            lambda: http_json("GET", "https://example.test/track", "tok"),
+        )
+
+        self.assertIsInstance(result, RuntimeError)
+        self.assertIn("HTTP 500", str(result))
+        self.assertEqual(request.call_count, publish_playstore.MAX_ATTEMPTS)
+
+    def test_commit_is_not_retried(self) -> None:
+        for outcome in (response(503), requests.ReadTimeout()):
+            with self.subTest(outcome=type(outcome).__name__):
+                result, request, sleep = self.run_with(
+                    [outcome, response(200)],
+                    lambda: commit_edit("tok", "com.example", "e1"),
+                )
+
+                self.assertIsInstance(result, (RuntimeError, requests.ReadTimeout))
+                self.assertEqual(request.call_count, 1)
+                self.assertEqual(request.call_args.kwargs["timeout"], publish_playstore.UPLOAD_TIMEOUT)
+                sleep.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()